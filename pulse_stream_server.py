@@ -1,228 +1,754 @@
 #!/usr/bin/env python3
 
-import http.server
 import socketserver
 import subprocess
 import threading
 import os
+import queue
 import argparse
+import array
+import contextlib
+import fcntl
+import functools
+import logging
+import logging.handlers
 import socket
+import statistics
 import sys
+import termios
 import time
+from concurrent.futures import ThreadPoolExecutor
 from soco import SoCo, discover
 from soco.exceptions import SoCoException
 
 DEFAULT_PORT = 8080
 OUTPUT_SAMPLE_RATE = 44100
 CHANNELS = 2
-BITRATE = "320k"
+BITRATE_KBPS = 320
+BITRATE = f"{BITRATE_KBPS}k"
 CAPTURE_DEVICE = "shared_capture"
 # METADATA_INTERVAL = 100000  # No longer needed without ICY metadata
+RING_SIZE = 8 * 1024 * 1024  # Shared encoder output buffer, must be a power of two
+MAX_CLIENT_LAG = 1024 * 1024  # Most a listener may trail the encoder, socket queue included (~26s at 320k)
+FRAME_SYNC = (b'\xff\xfb', b'\xff\xfa')  # MPEG-1 Layer III headers, without and with CRC
+ENCODER_READ_SIZE = 131072  # Largest single read from ffmpeg's stdout
+PIPE_SIZE = 1024 * 1024  # Kernel capacity of ffmpeg's stdout pipe
+SEND_BATCH_SIZE = 131072  # Most a listener sends per wakeup
+PROGRESS_BYTES = BITRATE_KBPS * 1000 // 8  # One second of audio between progress lines
+ENCODER_STARTUP_TIMEOUT = 5  # Seconds to wait for the encoder's first frame
+ENCODER_PROBE_SIZE = 16384  # Bytes of initial output searched for a frame header
+ENCODER_RT_PRIORITY = 10  # SCHED_RR priority for ffmpeg when permitted
+ENCODER_RESTART_DELAY = 1  # Seconds before restarting ffmpeg, doubled while it keeps failing
+ENCODER_MAX_RESTART_DELAY = 30  # Longest wait between restarts
+MAX_CLIENTS = 32  # Worker threads serving HTTP connections
+WORKER_STACK_SIZE = 512 * 1024  # Stack per connection worker thread
+DEFAULT_SNDBUF = 0  # Socket send buffer per listener; 0 leaves it to TCP autotuning
+CLIENT_TIMEOUT_MS = 30000  # Drop a listener whose data stays unacknowledged this long
+MAX_REQUEST_LINE = 65536  # Longest request or header line read from a client
+MAX_HEADERS = 100  # Most header lines accepted in a request, as in http.server
+REQUEST_TIMEOUT = 10  # Seconds a client gets to send its request before the worker gives up
+DISCOVERY_TIMEOUT = 3  # Seconds to collect SSDP replies; LAN speakers answer in well under one
+MAX_DISCOVERY_WORKERS = 32  # Most speakers queried at once for --list
+ACTIVE_TRANSPORT_STATES = ('PLAYING', 'PAUSED_PLAYBACK', 'TRANSITIONING')  # Stop the speaker before switching source
 
-class StreamHandler(http.server.BaseHTTPRequestHandler):
-    protocol_version = 'HTTP/1.0'  # Use HTTP/1.0 for better streaming compatibility
+# Per-chunk read/write timing. Off by default so the streaming loop makes no
+# clock calls; running under `python -O` strips it entirely.
+DEBUG_TIMING = False
+TIMING_WINDOW = 100  # Reads per statistics line
+SLOW_READ_NS = 100_000_000  # 100ms
+SLOW_WRITE_NS = 50_000_000  # 50ms
+
+# using alsa here 
+FFMPEG_INPUT_ARGS = [
+    '-nostdin',  # Prevent terminal state corruption
+    '-thread_queue_size', '4096',  # Doubled input buffer
+    # No -re: the ALSA capture already delivers audio in real time
+    '-f', 'alsa',
+    '-ar', '44100',  # Force input to be interpreted as 44.1kHz
+    '-i', CAPTURE_DEVICE,  # Use default PulseAudio source
+]
+
+# MP3 encoders selectable with --codec
+CODEC_ARGS = {
+    'libmp3lame': [
+        '-acodec', 'libmp3lame',
+        '-compression_level', '2',  # LAME -q 2; 0 is the slowest setting, not the fastest
+        '-reservoir', '0',  # No bit reservoir so every frame decodes on its own
+        '-joint_stereo', '0',
+    ],
+    # Fixed-point encoder, far cheaper on ARM and other low-power CPUs.
+    # Only present in ffmpeg builds configured with --enable-libshine.
+    'libshine': [
+        '-acodec', 'libshine',
+    ],
+}
+DEFAULT_CODEC = 'libmp3lame'
+
+FFMPEG_OUTPUT_ARGS = [
+    '-threads', '0',  # Let ffmpeg size its thread pools to the encoder's CPUs
+    '-b:a', BITRATE,
+    '-ar', str(OUTPUT_SAMPLE_RATE),  # Output sample rate (44100)
+    '-ac', str(CHANNELS),
+    '-f', 'mp3',
+    '-write_xing', '0',  # No Xing/Info frame, this is a live stream
+    '-id3v2_version', '0',  # No ID3v2 tag, so a restarted encoder's output starts with a frame
+    '-flush_packets', '1',  # Write each frame as soon as it is encoded
+    '-fflags', 'nobuffer',
+    # Add more aggressive buffering to ensure consistent data flow
+    # Real-time encoding settings
+    '-rtbufsize', '100M',  # Large real-time buffer
+    # Removed -preset ultrafast as it's for video encoding
+    '-'
+]
+
+# Logging arguments, depending on --debug-ffmpeg
+FFMPEG_QUIET_ARGS = ['-loglevel', 'error', '-nostats']
+FFMPEG_DEBUG_ARGS = [
+    '-loglevel', 'verbose',  # Verbose logging to diagnose delays
+    '-stats',  # Show real-time encoding statistics
+]
+
+LANDING_HTML = b"""\
+<html>
+<head><title>SPDIF PulseAudio Stream</title></head>
+<body>
+<h1>SPDIF PulseAudio Stream Server</h1>
+<p>Stream URL: <a href="/stream.mp3">/stream.mp3</a></p>
+<p>This stream is being served to a Sonos device.</p>
+<audio controls>
+<source src="/stream.mp3" type="audio/mpeg">
+</audio>
+<hr>
+<p>To set your SPDIF as the default PulseAudio source:</p>
+<pre>
+# List audio sources
+pactl list sources short
+
+# Set default source (replace with your SPDIF source name)
+pactl set-default-source alsa_input.usb-xxx
+</pre>
+</body>
+</html>
+"""
+
+# Complete responses built once, each sent with a single write
+LANDING_RESPONSE = (
+    b"HTTP/1.0 200 OK\r\n"
+    b"Content-Type: text/html\r\n"
+    b"Content-Length: %d\r\n"
+    b"Connection: close\r\n"
+    b"\r\n" % len(LANDING_HTML)
+) + LANDING_HTML
+STREAM_HEADERS = (
+    b"HTTP/1.0 200 OK\r\n"
+    b"Content-Type: audio/mpeg\r\n"
+    # Try a much larger fake length to see if it helps
+    # Some users report 100GB works better than 10GB
+    b"Content-Length: %d\r\n"
+    b"Cache-Control: no-cache\r\n"
+    # Try keep-alive instead of close to prevent early disconnection
+    b"Connection: keep-alive\r\n"
+    # No ICY metadata needed for SPDIF stream
+    b"\r\n" % (100 * 1024 * 1024 * 1024)  # 100GB fake length
+)
+NOT_FOUND_RESPONSE = (
+    b"HTTP/1.0 404 Not Found\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"Content-Length: 10\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+    b"Not Found\n"
+)
+BAD_REQUEST_RESPONSE = (
+    b"HTTP/1.0 400 Bad Request\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"Content-Length: 12\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+    b"Bad Request\n"
+)
+HEADERS_TOO_LARGE_RESPONSE = (
+    b"HTTP/1.0 431 Request Header Fields Too Large\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"Content-Length: 17\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+    b"Too many headers\n"
+)
+NOT_IMPLEMENTED_RESPONSE = (
+    b"HTTP/1.0 501 Not Implemented\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"Content-Length: 16\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+    b"Not Implemented\n"
+)
+
+log = logging.getLogger("pulse_stream_server")
+
+def setup_logging(level):
+    """Route log records through a queue so stream threads never wait on stdout"""
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("[%(asctime)s.%(msecs)03d] %(message)s", "%H:%M:%S"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(level)
+    log.propagate = False
+    listener.start()
+    return listener
+
+class ClientTooSlow(Exception):
+    """Raised when a listener falls too far behind the encoder to keep up"""
+
+class StreamRing:
+    """Single-producer, multi-consumer ring buffer of encoded MP3 bytes
+    
+    The encoder thread is the only writer. Listeners never take the lock to
+    copy data out; they only use the condition to sleep until more arrives.
+    Positions are absolute byte counts and are wrapped with the mask.
+    """
+    def __init__(self, capacity=RING_SIZE):
+        if capacity & (capacity - 1):
+            raise ValueError("ring capacity must be a power of two")
+        # Room for one encoder read plus the furthest a listener may trail it,
+        # so slow listeners are dropped for lag before they can be lapped
+        if capacity < ENCODER_READ_SIZE + MAX_CLIENT_LAG:
+            raise ValueError(f"ring capacity must be at least {ENCODER_READ_SIZE + MAX_CLIENT_LAG} bytes")
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.write_index = 0
+        self.closed = False
+        self.cond = threading.Condition()
+    
+    def fill_from(self, fd, size):
+        """Read up to size bytes from fd straight into the ring and wake listeners
+        
+        Returns the number of bytes read, 0 at end of file.
+        """
+        start = self.write_index & self.mask
+        end = start + size
+        if end <= self.capacity:
+            n = os.readv(fd, [self.view[start:end]])
+        else:
+            n = os.readv(fd, [self.view[start:], self.view[:end - self.capacity]])
+        if n:
+            with self.cond:
+                self.write_index += n
+                self.cond.notify_all()
+        return n
+    
+    def close(self):
+        """Mark the end of the stream so listeners stop waiting"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+    
+    def wait(self, cursor, timeout=None):
+        """Block until there is data past cursor; returns how much (0 once closed or timed out)"""
+        if self.write_index <= cursor:
+            with self.cond:
+                self.cond.wait_for(lambda: self.write_index > cursor or self.closed, timeout)
+        return self.write_index - cursor
+    
+    def segments(self, cursor, size):
+        """Views over up to size bytes starting at cursor, split where the ring wraps"""
+        n = min(size, self.wait(cursor))
+        if n <= 0:
+            return []
+        start = cursor & self.mask
+        end = start + n
+        if end <= self.capacity:
+            return [self.view[start:end]]
+        return [self.view[start:], self.view[:end - self.capacity]]
+    
+    def check(self, cursor):
+        """Raise ClientTooSlow if the encoder may have overwritten data at cursor"""
+        if self.write_index + ENCODER_READ_SIZE - cursor > self.capacity:
+            raise ClientTooSlow()
+    
+    def read(self, cursor, size):
+        """Return a copy of up to size bytes starting at cursor, or b'' once closed"""
+        data = b''.join(self.segments(cursor, size))
+        # The encoder may have overwritten this region while we were copying it
+        self.check(cursor)
+        return data
+
+class RingReader:
+    """One listener's position in a StreamRing, starting at the live edge
+    
+    A reader more than max_lag bytes behind the encoder is dropped with
+    ClientTooSlow, long before the ring itself could lap it. Data sent but
+    still queued in the socket counts as lag, or a stalled listener could
+    hide a whole send buffer's worth behind it.
+    """
+    def __init__(self, ring, max_lag=MAX_CLIENT_LAG):
+        self.ring = ring
+        self.cursor = ring.write_index
+        self.max_lag = max_lag
+    
+    def sync(self):
+        """Skip ahead to the next MP3 frame header so a new listener starts cleanly"""
+        while True:
+            data = self.ring.read(self.cursor, 4096)
+            if len(data) < 2:
+                # Need at least a whole sync word to look at
+                if not self.ring.wait(self.cursor + len(data)):
+                    return
+                continue
+            found = [i for i in (data.find(sync) for sync in FRAME_SYNC) if i >= 0]
+            if found:
+                self.cursor += min(found)
+                return
+            # Keep the last byte in case it is the first half of a sync word
+            self.cursor += len(data) - 1
+    
+    def peek(self, size):
+        """Views over the next size bytes without copying or consuming them"""
+        return self.ring.segments(self.cursor, size)
+    
+    def send(self, sock, views, header=b''):
+        """Send views from peek() straight out of the ring and consume them
+        
+        A header is sent ahead of them in the same sendmsg() call. Returns the
+        number of stream bytes sent, not counting the header.
+        """
+        total = sum(len(view) for view in views)
+        _sendmsg_all(sock, [header, *views] if header else views)
+        # Bytes the encoder overwrote mid-send went out corrupted
+        self.ring.check(self.cursor)
+        self.cursor += total
+        if self.ring.write_index - self.cursor + _unsent_bytes(sock) > self.max_lag:
+            raise ClientTooSlow()
+        return total
+
+def _unsent_bytes(sock):
+    """Bytes still in sock's send queue, sent by us but not yet acknowledged (SIOCOUTQ)"""
+    queued = array.array('i', [0])
+    fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, queued)
+    return queued[0]
+
+def _sendmsg_all(sock, buffers):
+    """Send every buffer with scatter/gather sendmsg(), resuming after short sends"""
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+class StreamHandler(socketserver.StreamRequestHandler):
+    """Minimal HTTP/1.0 handler that only looks at the request line
+    
+    Every response is a prebuilt blob written straight to the socket, so
+    there is no header parsing and no buffered writer in the audio path.
+    """
+    # Applies while reading the request, so an idle connection can't hold a worker
+    timeout = REQUEST_TIMEOUT
+    
+    def handle(self):
+        try:
+            self.requestline = self.rfile.readline(MAX_REQUEST_LINE).rstrip(b'\r\n').decode('latin-1')
+            # Skip the request headers; nothing here depends on them
+            for _ in range(MAX_HEADERS + 1):
+                if self.rfile.readline(MAX_REQUEST_LINE) in (b'\r\n', b'\n', b''):
+                    break
+            else:
+                self.connection.sendall(HEADERS_TOO_LARGE_RESPONSE)
+                self.log_request(431)
+                return
+        except TimeoutError:
+            log.info("%s - timed out waiting for a request", self.client_address[0])
+            return
+        
+        words = self.requestline.split()
+        if len(words) != 3:
+            if words:
+                self.connection.sendall(BAD_REQUEST_RESPONSE)
+                self.log_request(400)
+            return
+        method, self.path, _ = words
+        if method != 'GET':
+            self.connection.sendall(NOT_IMPLEMENTED_RESPONSE)
+            self.log_request(501)
+            return
+        self.do_GET()
+    
     def do_GET(self):
         if self.path == '/stream.mp3':
-            self.send_response(200)
-            self.send_header('Content-Type', 'audio/mpeg')
-            # Try a much larger fake length to see if it helps
-            # Some users report 100GB works better than 10GB
-            self.send_header('Content-Length', str(100 * 1024 * 1024 * 1024))  # 100GB fake length
-            self.send_header('Cache-Control', 'no-cache')
-            # Try keep-alive instead of close to prevent early disconnection
-            self.send_header('Connection', 'keep-alive')
-            # No ICY metadata needed for SPDIF stream
-            self.end_headers()
+            sock = self.connection
+            # Stream sends block for as long as the listener needs; a listener
+            # that stops acknowledging is cut off by TCP_USER_TIMEOUT instead
+            sock.settimeout(None)
+            self.tune_stream_socket(sock)
+            self.log_request(200)
             
-            # using alsa here 
-            ffmpeg_cmd = [
-                'ffmpeg',
-                '-nostdin',  # Prevent terminal state corruption
-                '-loglevel', 'verbose',  # Verbose logging to diagnose delays
-                '-stats',  # Show real-time encoding statistics
-                '-thread_queue_size', '4096',  # Doubled input buffer
-                '-re',
-                '-f', 'alsa',
-                '-ar', '44100',  # Force input to be interpreted as 44.1kHz
-                '-i', CAPTURE_DEVICE,  # Use default PulseAudio source
-                '-acodec', 'libmp3lame',
-                '-compression_level', '0',  # Fastest encoding, lowest compression
-                '-b:a', BITRATE,
-                '-ar', str(OUTPUT_SAMPLE_RATE),  # Output sample rate (44100)
-                '-ac', str(CHANNELS),
-                '-f', 'mp3',
-                '-flush_packets', '0',
-                '-fflags', 'nobuffer',
-                # Add more aggressive buffering to ensure consistent data flow
-                # Real-time encoding settings
-                '-rtbufsize', '100M',  # Large real-time buffer
-                # Removed -preset ultrafast as it's for video encoding
-                '-'
-            ]
-            
-            print(f"Streaming to {self.client_address[0]}:{self.client_address[1]}")
+            log.info("Streaming to %s:%d", *self.client_address)
             
+            # Every listener reads the same encoder output from its own cursor
+            stream = RingReader(self.server.ring)
+            bytes_sent = 0
             try:
-                process = subprocess.Popen(
-                    ffmpeg_cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,  # Capture stderr for diagnostics
-                    bufsize=1048576  # 1MB buffer for smoother reads
-                )
+                stream.sync()
+                # Headers go out with the first frames in a single sendmsg()
+                bytes_sent = stream.send(sock, stream.peek(SEND_BATCH_SIZE), STREAM_HEADERS)
                 
-                # Monitor ffmpeg stderr in a separate thread
-                def monitor_ffmpeg_stderr():
-                    for line in process.stderr:
-                        if line:
-                            timestamp = time.strftime('%H:%M:%S.%f')[:-3]
-                            print(f"[{timestamp}] FFmpeg: {line.decode('utf-8').strip()}")
+                # Progress lines are DEBUG only; without them the loop keeps no clock
+                report_progress = log.isEnabledFor(logging.DEBUG)
+                bytes_until_progress = PROGRESS_BYTES
+                # Take everything published since the last wakeup in one go,
+                # so a listener does one read and one send per encoder chunk
+                chunk_size = SEND_BATCH_SIZE
                 
-                stderr_thread = threading.Thread(target=monitor_ffmpeg_stderr)
-                stderr_thread.daemon = True
-                stderr_thread.start()
+                if __debug__ and DEBUG_TIMING:
+                    read_times = array.array('Q', bytes(8 * TIMING_WINDOW))
+                    read_count = 0
                 
-                try:
-                    bytes_sent = 0
-                    last_log_kb = 0
-                    chunk_size = 2048  # 8KB chunks
-                    
-                    # Track read timing statistics
-                    read_times = []  # Track read durations
-                    slow_read_threshold = 0.1  # 100ms threshold
-                    
-                    # Pre-buffer 2 seconds of audio
-                    # At 320kbps = 40KB/s, so 2 seconds = 80KB
-                    prebuffer_size = 40960  # 80KB for 2 seconds at 320kbps
-                    print(f"Pre-buffering {prebuffer_size // 1024}KB (2 seconds) before starting stream...")
-                    prebuffer = b''
-                    prebuffer_start = time.time()
-                    
-                    while len(prebuffer) < prebuffer_size:
-                        data = process.stdout.read(8192)
-                        if not data:
-                            break
-                        prebuffer += data
-                    
-                    prebuffer_duration = time.time() - prebuffer_start
-                    print(f"Pre-buffered {len(prebuffer) // 1024}KB in {prebuffer_duration:.2f}s")
-                    
-                    # Send the pre-buffered data
-                    if prebuffer:
-                        write_start = time.time()
-                        self.wfile.write(prebuffer)
-                        write_duration = time.time() - write_start
-                        bytes_sent = len(prebuffer)
-                        print(f"Sent initial {bytes_sent // 1024}KB buffer in {write_duration:.3f}s")
-                    
-                    while True:
-                        # Time the read operation
-                        read_start = time.time()
-                        data = process.stdout.read(chunk_size)
-                        read_duration = time.time() - read_start
-                        
-                        # Track read statistics
-                        read_times.append(read_duration)
-                        if read_duration > slow_read_threshold:
-                            timestamp = time.strftime('%H:%M:%S.%f')[:-3]
-                            print(f"[{timestamp}] SLOW READ WARNING: ffmpeg read took {read_duration:.3f}s (requested {chunk_size} bytes)")
-                        
-                        # Log statistics every 100 reads
-                        if len(read_times) >= 100:
-                            avg_read_time = sum(read_times) / len(read_times)
-                            max_read_time = max(read_times)
-                            slow_reads = sum(1 for t in read_times if t > slow_read_threshold)
-                            print(f"Read stats - Avg: {avg_read_time:.3f}s, Max: {max_read_time:.3f}s, Slow reads: {slow_reads}/100")
-                            read_times = []
-                        
-                        if not data:
-                            print(f"WARNING: ffmpeg returned no data after {read_duration:.3f}s wait")
-                            break
-                        
-                        # Send raw MP3 data (no chunked encoding)
-                        write_start = time.time()
-                        self.wfile.write(data)
-                        write_duration = time.time() - write_start
-                        if write_duration > 0.05:  # 50ms threshold
-                            print(f"SLOW WRITE WARNING: network write took {write_duration:.3f}s for {len(data)} bytes")
-                        
-                        bytes_sent += len(data)
+                while True:
+                    if __debug__ and DEBUG_TIMING:
+                        read_start = time.monotonic_ns()
+                    data = stream.peek(chunk_size)
+                    if __debug__ and DEBUG_TIMING:
+                        read_duration = time.monotonic_ns() - read_start
+                        read_times[read_count] = read_duration
+                        read_count += 1
+                        if read_duration > SLOW_READ_NS:
+                            log.warning("SLOW READ WARNING: ffmpeg read took %.3fs (requested %d bytes)", read_duration / 1e9, chunk_size)
                         
-                        # Log every 10KB with more detail around 1MB mark
-                        current_kb = bytes_sent // 10240
-                        if current_kb > last_log_kb:
-                            last_log_kb = current_kb
-                            total_kb = current_kb * 10
-                            # Extra logging around the 1MB mark where disconnects happen
-                            if 1000 <= total_kb <= 1200:
-                                print(f"[CRITICAL ZONE] Sent {total_kb}KB to {self.client_address[0]} - bytes_sent: {bytes_sent}")
-                            else:
-                                print(f"Sent {total_kb}KB to {self.client_address[0]}")
+                        # Log statistics every TIMING_WINDOW reads
+                        if read_count == TIMING_WINDOW:
+                            avg_read_time = statistics.fmean(read_times) / 1e9
+                            max_read_time = max(read_times) / 1e9
+                            slow_reads = sum(1 for t in read_times if t > SLOW_READ_NS)
+                            log.debug("Read stats - Avg: %.3fs, Max: %.3fs, Slow reads: %d/%d", avg_read_time, max_read_time, slow_reads, TIMING_WINDOW)
+                            read_count = 0
                     
-                    print(f"Stream ended. Total sent: {bytes_sent / 1024:.1f}KB to {self.client_address[0]}")
+                    if not data:
+                        log.warning("ffmpeg encoder stream ended")
+                        break
                     
-                except (BrokenPipeError, ConnectionResetError, OSError) as e:
-                    print(f"Client {self.client_address[0]} disconnected after {bytes_sent / 1024:.1f}KB: {type(e).__name__}")
-                finally:
-                    process.terminate()
-                    try:
-                        process.wait(timeout=2)
-                    except subprocess.TimeoutExpired:
-                        process.kill()
-                        process.wait()
+                    # Send raw MP3 data (no chunked encoding)
+                    if __debug__ and DEBUG_TIMING:
+                        write_start = time.monotonic_ns()
+                    sent = stream.send(sock, data)
+                    if __debug__ and DEBUG_TIMING:
+                        write_duration = time.monotonic_ns() - write_start
+                        if write_duration > SLOW_WRITE_NS:
+                            log.warning("SLOW WRITE WARNING: network write took %.3fs for %d bytes", write_duration / 1e9, sent)
                     
-            except Exception as e:
-                print(f"Error streaming: {e}")
+                    bytes_sent += sent
+                    
+                    # Report progress about once a second of audio
+                    if report_progress:
+                        bytes_until_progress -= sent
+                        if bytes_until_progress <= 0:
+                            bytes_until_progress = PROGRESS_BYTES
+                            log.debug("Sent %dKB to %s", bytes_sent // 1024, self.client_address[0])
+                
+                log.info("Stream ended. Total sent: %.1fKB to %s", bytes_sent / 1024, self.client_address[0])
+                
+            except ClientTooSlow:
+                log.warning("Dropping client %s after %.1fKB: fell more than %dKB behind the encoder", self.client_address[0], bytes_sent / 1024, stream.max_lag // 1024)
+            except (BrokenPipeError, ConnectionResetError, OSError) as e:
+                log.info("Client %s disconnected after %.1fKB: %s", self.client_address[0], bytes_sent / 1024, type(e).__name__)
                 
         elif self.path == '/':
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html')
-            self.end_headers()
-            self.wfile.write(b"""
-            <html>
-            <head><title>SPDIF PulseAudio Stream</title></head>
-            <body>
-                <h1>SPDIF PulseAudio Stream Server</h1>
-                <p>Stream URL: <a href="/stream.mp3">/stream.mp3</a></p>
-                <p>This stream is being served to a Sonos device.</p>
-                <audio controls>
-                    <source src="/stream.mp3" type="audio/mpeg">
-                </audio>
-                <hr>
-                <p>To set your SPDIF as the default PulseAudio source:</p>
-                <pre>
-# List audio sources
-pactl list sources short
-
-# Set default source (replace with your SPDIF source name)
-pactl set-default-source alsa_input.usb-xxx
-                </pre>
-            </body>
-            </html>
-            """)
+            self.connection.sendall(LANDING_RESPONSE)
+            self.log_request(200)
         else:
-            self.send_error(404)
+            self.connection.sendall(NOT_FOUND_RESPONSE)
+            self.log_request(404)
+    
+    def tune_stream_socket(self, sock):
+        """Apply the server's TCP options to a streaming connection"""
+        if self.server.nodelay:
+            # Each batch is one sendmsg(), so Nagle would only add delay
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.server.sndbuf:
+            # A fixed size turns off autotuning, and the kernel silently caps it
+            # at net.core.wmem_max (reporting back double what it allows)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.server.sndbuf)
+            granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) // 2
+            if granted < self.server.sndbuf:
+                log.warning("Send buffer limited to %dKB by net.core.wmem_max (asked for %dKB)", granted // 1024, self.server.sndbuf // 1024)
+        # Notice a Sonos that vanished without closing the connection. Keepalive
+        # covers idle periods; while audio is flowing only the user timeout
+        # fires, instead of after the ~15 minutes of default retransmissions.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, CLIENT_TIMEOUT_MS)
     
-    def log_message(self, format, *args):
-        if '/favicon.ico' not in format % args:
-            print(f"{self.client_address[0]} - {format % args}")
+    def log_request(self, code):
+        """Access log line in the same format http.server used"""
+        if '/favicon.ico' not in self.requestline:
+            log.info('%s - "%s" %d -', self.client_address[0], self.requestline, code)
 
-class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+class ThreadedTCPServer(socketserver.TCPServer):
+    """TCPServer that hands each connection to a fixed pool of worker threads"""
     allow_reuse_address = True
-    daemon_threads = True
+    request_queue_size = 128  # listen() backlog while every worker is busy
+    # Shared encoder output, attached in main() before serving
+    ring = None
+    # Socket options for streaming connections, see --nodelay and --sndbuf
+    nodelay = True
+    sndbuf = DEFAULT_SNDBUF
+    
+    def __init__(self, *args, **kwargs):
+        # Connections beyond MAX_CLIENTS wait for a free worker
+        self.pool = ThreadPoolExecutor(max_workers=MAX_CLIENTS, thread_name_prefix="stream")
+        # Open connections, so server_close() can unblock their workers
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+    
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+    
+    def process_request_thread(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self.connections_lock:
+                self.connections.discard(request)
+            self.shutdown_request(request)
+    
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        # The workers are not daemon threads and the interpreter joins them on
+        # exit, so wake every one blocked on a client or waiting for audio
+        if self.ring is not None:
+            self.ring.close()
+        with self.connections_lock:
+            for request in self.connections:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+def enlarge_pipe(fd, size=PIPE_SIZE):
+    """Raise a pipe's kernel capacity, settling for the system limit if size is above it"""
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, size)
+        return
+    except PermissionError:
+        # Unprivileged processes are capped at fs.pipe-max-size
+        try:
+            with open('/proc/sys/fs/pipe-max-size') as f:
+                limit = int(f.read())
+            if limit < size:
+                fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, limit)
+                log.info("ffmpeg pipe limited to %dKB by fs.pipe-max-size", limit // 1024)
+                return
+        except (OSError, ValueError):
+            pass
+    except OSError as e:
+        log.warning("Could not enlarge ffmpeg pipe to %dKB: %s", size // 1024, e)
+        return
+    log.warning("Could not enlarge ffmpeg pipe to %dKB: permission denied", size // 1024)
+
+def split_cpus():
+    """Divide this process's CPUs into (encoder, server) halves
+    
+    With a single CPU both get it and no affinity is applied.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    half = len(cpus) // 2
+    return cpus[half:], cpus[:half] or cpus
+
+@contextlib.contextmanager
+def encoder_scheduling(encoder_cpus, server_cpus):
+    """Run the block with the encoder's CPU affinity and real-time priority
+    
+    A child process inherits both from the thread that starts it, including
+    every thread ffmpeg creates later. The calling thread takes them on for
+    the duration of the block, then moves to server_cpus so the server's
+    threads stay off the encoder's cores.
+    """
+    pinned = encoder_cpus != server_cpus
+    if pinned:
+        os.sched_setaffinity(0, encoder_cpus)
+    try:
+        os.sched_setscheduler(0, os.SCHED_RR, os.sched_param(ENCODER_RT_PRIORITY))
+        realtime = True
+    except PermissionError:
+        realtime = False
+    try:
+        yield
+    finally:
+        if realtime:
+            os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+        if pinned:
+            os.sched_setaffinity(0, server_cpus)
+            log.info("Encoder on CPUs %s, server on CPUs %s", encoder_cpus, server_cpus)
+        if not realtime:
+            log.info("No permission for real-time scheduling, ffmpeg runs at normal priority")
+
+@functools.cache
+def available_encoders():
+    """Names of the audio encoders in this ffmpeg build, asked for only once"""
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                                capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return frozenset()
+    # A legend (" A..... = Audio") comes first; the list starts after " ------".
+    # Lines look like " A....D libmp3lame  libmp3lame MP3 (MPEG audio layer 3)"
+    _, _, listing = result.stdout.partition(' ------\n')
+    return frozenset(fields[1] for fields in map(str.split, listing.splitlines())
+                     if len(fields) > 1 and fields[0].startswith('A'))
 
+def resolve_codec(codec):
+    """Turn --codec auto into the cheapest MP3 encoder ffmpeg has"""
+    if codec == 'auto':
+        return 'libshine' if 'libshine' in available_encoders() else 'libmp3lame'
+    return codec
+
+def build_ffmpeg_cmd(codec=DEFAULT_CODEC, debug=False):
+    """Assemble the encoder command line for the given codec"""
+    log_args = FFMPEG_DEBUG_ARGS if debug else FFMPEG_QUIET_ARGS
+    return ['ffmpeg'] + log_args + FFMPEG_INPUT_ARGS + CODEC_ARGS[codec] + FFMPEG_OUTPUT_ARGS
+
+class Encoder:
+    """The single shared ffmpeg encoder, restarted with backoff whenever it exits
+    
+    Every run feeds the same ring, so its write index keeps counting up and
+    listeners just wait through a restart (an ALSA xrun, a replugged S/PDIF
+    dongle) instead of finding the stream gone for good. ffmpeg's stderr is
+    discarded unless debug is set, in which case it runs verbosely and a
+    monitor thread logs each line.
+    """
+    def __init__(self, ring, codec=DEFAULT_CODEC, debug=False):
+        self.ring = ring
+        self.codec = codec
+        self.debug = debug
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        # Split once: restarts run on the pump thread, which is already
+        # confined to the server's CPUs and would otherwise split those again
+        self.encoder_cpus, self.server_cpus = split_cpus()
+        self.process = self.spawn()
+        threading.Thread(target=self.pump, daemon=True).start()
+    
+    def spawn(self):
+        with encoder_scheduling(self.encoder_cpus, self.server_cpus):
+            process = subprocess.Popen(
+                build_ffmpeg_cmd(self.codec, self.debug),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE if self.debug else subprocess.DEVNULL,
+                bufsize=0,  # The enlarged pipe is the buffer; read it directly
+                start_new_session=True  # Ctrl+C is for us; stop() ends ffmpeg itself
+            )
+        
+        # Give ffmpeg room to keep writing through scheduling hiccups on our side
+        enlarge_pipe(process.stdout.fileno())
+        
+        # Monitor ffmpeg stderr in a separate thread
+        def monitor_ffmpeg_stderr():
+            for line in process.stderr:
+                if line:
+                    log.info("FFmpeg: %s", line.decode('utf-8', 'replace').strip())
+        
+        if self.debug:
+            threading.Thread(target=monitor_ffmpeg_stderr, daemon=True).start()
+        return process
+    
+    def pump(self):
+        """Publish encoded MP3 as soon as ffmpeg hands it over, restarting it when it exits"""
+        delay = ENCODER_RESTART_DELAY
+        process = self.process
+        while True:
+            # process is None after a restart attempt failed to start ffmpeg at all
+            if process:
+                started = time.monotonic()
+                fd = process.stdout.fileno()
+                while self.ring.fill_from(fd, ENCODER_READ_SIZE):
+                    pass
+                process.stdout.close()
+                returncode = process.wait()
+                if self.stopping.is_set():
+                    break
+                # Only back off while ffmpeg keeps failing straight away
+                if time.monotonic() - started >= ENCODER_MAX_RESTART_DELAY:
+                    delay = ENCODER_RESTART_DELAY
+                log.warning("ffmpeg encoder exited with status %s, restarting in %ds", returncode, delay)
+            if self.stopping.wait(delay):
+                break
+            with self.lock:
+                if self.stopping.is_set():
+                    break
+                try:
+                    process = self.process = self.spawn()
+                except OSError as e:
+                    process = None
+                    log.warning("Could not restart ffmpeg: %s, retrying in %ds", e, min(delay * 2, ENCODER_MAX_RESTART_DELAY))
+            delay = min(delay * 2, ENCODER_MAX_RESTART_DELAY)
+        self.ring.close()
+        log.warning("ffmpeg encoder stopped producing data")
+    
+    def stop(self):
+        """Terminate the encoder for good, killing it if it does not exit promptly"""
+        with self.lock:
+            self.stopping.set()
+            process = self.process
+        process.terminate()
+        try:
+            process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def check_encoder_output(ring, timeout=ENCODER_STARTUP_TIMEOUT):
+    """Wait for the encoder's first MP3 frame; returns an error message if none arrives"""
+    deadline = time.monotonic() + timeout
+    head = b''
+    while len(head) < ENCODER_PROBE_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not ring.wait(len(head), remaining):
+            break
+        head += ring.read(len(head), ENCODER_PROBE_SIZE - len(head))
+        if any(sync in head for sync in FRAME_SYNC):
+            return None
+    if not head:
+        return f"ffmpeg produced no audio within {timeout}s, check that {CAPTURE_DEVICE} can be captured"
+    return f"no MP3 frame header in the first {len(head)} bytes from ffmpeg"
+
+@functools.cache
 def get_server_ip():
-    """Get the server's IP address on the local network"""
+    """Get the server's IP address on the local network, detecting it only once"""
     try:
         # Create a socket to determine the local IP
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        # Connect to a public DNS server (doesn't actually send data)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            # Connect to a public DNS server (doesn't actually send data)
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+    except OSError:
+        # No default route (e.g. an air-gapped LAN), so use whatever
+        # non-loopback address the hostname resolves to
+        pass
+    try:
+        for *_, sockaddr in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            if not sockaddr[0].startswith("127."):
+                return sockaddr[0]
+    except OSError:
+        pass
+    # Fallback to localhost if we can't determine the IP
+    return "127.0.0.1"
+
+def _device_row(device):
+    """Return the (IP, zone, model, transport state) row printed by --list"""
+    try:
+        info = device.get_speaker_info()
+        status = device.get_current_transport_info()['current_transport_state']
+        return device.ip_address, info['zone_name'], info['model_name'], status
     except Exception:
-        # Fallback to localhost if we can't determine the IP
-        return "127.0.0.1"
+        return device.ip_address, '(Unable to get info)', 'Unknown', 'Unknown'
 
 def list_sonos_devices():
     """Discover and list all Sonos devices on the network"""
@@ -230,7 +756,7 @@ def list_sonos_devices():
     print("This may take a few seconds...\n")
     
     try:
-        devices = discover(timeout=10)
+        devices = discover(timeout=DISCOVERY_TIMEOUT)
         
         if not devices:
             print("No Sonos devices found on the network.")
@@ -240,13 +766,12 @@ def list_sonos_devices():
         print(f"{'IP Address':<15} {'Zone Name':<25} {'Model':<20} {'Status'}")
         print("-" * 80)
         
-        for device in devices:
-            try:
-                info = device.get_speaker_info()
-                status = device.get_current_transport_info()['current_transport_state']
-                print(f"{device.ip_address:<15} {info['zone_name']:<25} {info['model_name']:<20} {status}")
-            except Exception as e:
-                print(f"{device.ip_address:<15} {'(Unable to get info)':<25} {'Unknown':<20} {'Unknown'}")
+        # Each lookup is a blocking round trip to one speaker, so ask them all at once
+        with ThreadPoolExecutor(max_workers=min(MAX_DISCOVERY_WORKERS, len(devices))) as executor:
+            rows = list(executor.map(_device_row, devices))
+        
+        for ip_address, zone_name, model_name, status in rows:
+            print(f"{ip_address:<15} {zone_name:<25} {model_name:<20} {status}")
         
         print("\nUse one of these IP addresses with the script to stream to that device.")
         print("Example: python3 pulse_stream_server.py <IP_ADDRESS>")
@@ -270,11 +795,20 @@ def connect_to_sonos(sonos_ip):
 def play_stream_on_sonos(sonos, stream_url):
     """Tell the Sonos to play our stream"""
     try:
-        # Stop current playback if any
-        sonos.stop()
-        
-        # Clear the queue
-        sonos.clear_queue()
+        # Each call is a SOAP round trip, so probe the transport state and queue
+        # together and skip the stop/clear a freshly idle speaker doesn't need
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            transport = executor.submit(sonos.get_current_transport_info)
+            queue_size = executor.submit(lambda: sonos.queue_size)
+            pending = []
+            # Stop current playback if any
+            if transport.result().get('current_transport_state') in ACTIVE_TRANSPORT_STATES:
+                pending.append(executor.submit(sonos.stop))
+            # Clear the queue
+            if queue_size.result():
+                pending.append(executor.submit(sonos.clear_queue))
+            for future in pending:
+                future.result()
         
         # Convert http URL to x-rincon-mp3radio URL for better streaming
         # This tells Sonos to use its radio streaming mode with better buffering
@@ -300,6 +834,18 @@ def main():
                         help=f'Port to run the stream server on (default: {DEFAULT_PORT})')
     parser.add_argument('--list', '-l', action='store_true',
                         help='List all available Sonos devices and exit')
+    parser.add_argument('--bind', metavar='IP',
+                        help='Address to listen on and give to the Sonos (default: autodetect)')
+    parser.add_argument('--sndbuf', type=int, default=DEFAULT_SNDBUF,
+                        help='Fixed send buffer size for stream connections in bytes (default: 0, let TCP autotune it)')
+    parser.add_argument('--nodelay', action=argparse.BooleanOptionalAction, default=True,
+                        help='Disable Nagle\'s algorithm on stream connections (default: on)')
+    parser.add_argument('--codec', choices=['auto'] + sorted(CODEC_ARGS), default=DEFAULT_CODEC,
+                        help=f'MP3 encoder for ffmpeg to use, auto picks libshine when ffmpeg has it (default: {DEFAULT_CODEC})')
+    parser.add_argument('--debug', action='store_true',
+                        help='Log per-chunk streaming details')
+    parser.add_argument('--debug-ffmpeg', action='store_true',
+                        help='Run ffmpeg with verbose logging and show its output')
     args = parser.parse_args()
     
     # If --list is specified, show devices and exit
@@ -313,7 +859,7 @@ def main():
         sys.exit(1)
     
     # Get server IP
-    server_ip = get_server_ip()
+    server_ip = args.bind or get_server_ip()
     stream_url = f"http://{server_ip}:{args.port}/stream.mp3"
     
     print(f"Server IP: {server_ip}")
@@ -331,19 +877,33 @@ def main():
     subprocess.run(['pactl', 'list', 'sources', 'short'])
     print()
     
+    log_listener = setup_logging(logging.DEBUG if args.debug else logging.INFO)
+    
     print(f"PulseAudio Stream Server starting on port {args.port}")
     print("Using default PulseAudio source")
     
-    # Start the HTTP server in a separate thread
-    httpd = ThreadedTCPServer(("", args.port), StreamHandler)
-    server_thread = threading.Thread(target=httpd.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
+    # One encoder for all listeners
+    ring = StreamRing()
+    codec = resolve_codec(args.codec)
+    encoder = Encoder(ring, codec=codec, debug=args.debug_ffmpeg)
+    print(f"Started shared ffmpeg encoder ({codec})")
     
-    print("\nHTTP server started")
+    # Fail now rather than when the Sonos connects to a silent stream
+    error = check_encoder_output(ring)
+    if error:
+        print(f"Encoder check failed: {error}")
+        encoder.stop()
+        log_listener.stop()
+        sys.exit(1)
+    
+    # The server is bound and listening once constructed, so the Sonos can
+    # connect right away; its request waits in the backlog until we serve
+    httpd = ThreadedTCPServer((args.bind or "", args.port), StreamHandler)
+    httpd.ring = ring
+    httpd.nodelay = args.nodelay
+    httpd.sndbuf = args.sndbuf
     
-    # Give the server a moment to start
-    time.sleep(1)
+    print("\nHTTP server listening")
     
     # Tell Sonos to play the stream
     print("\nConfiguring Sonos to play the stream...")
@@ -354,10 +914,14 @@ def main():
         print("\nWarning: Failed to start playback on Sonos, but stream server is running.")
         print(f"You can manually play the stream URL on your Sonos: {stream_url}")
     
+    # Connection workers only parse a request line and then wait and send,
+    # so they don't need the default 8MB thread stacks. This is process-wide,
+    # so it is set only now that the Sonos calls and their threads are done.
+    threading.stack_size(WORKER_STACK_SIZE)
+    
     try:
-        # Keep the main thread alive
-        while True:
-            time.sleep(1)
+        # Serve on the main thread until Ctrl+C
+        httpd.serve_forever()
     except KeyboardInterrupt:
         print("\nShutting down...")
         try:
@@ -368,9 +932,14 @@ def main():
         except:
             pass
         
-        # Shutdown the HTTP server
-        httpd.shutdown()
+        # serve_forever() has already returned, so just close the socket
+        httpd.server_close()
         print("HTTP server stopped")
+        
+        encoder.stop()
+        print("Encoder stopped")
+        
+        log_listener.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file